@@ -1,20 +1,55 @@
 import argparse
+import collections
+import errno
+import functools
 import importlib.metadata
 import mimetypes
 import os
-import tempfile
+import threading
+import time
+import unicodedata
 import zipfile
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
 from pathlib import Path
-from urllib.parse import parse_qs, quote, unquote
-
-from flask import Flask, abort, jsonify, render_template, request, send_file
+from stat import S_ISREG
+from typing import NamedTuple
+from urllib.parse import quote, unquote
+
+from flask import (
+    Flask,
+    Response,
+    abort,
+    jsonify,
+    request,
+    send_file,
+    send_from_directory,
+)
 
 app = Flask(__name__)
 
 
 DEFAULT_ROOT = (Path.cwd() / "share").resolve()
 ICON_PATH = "icons/"
+ASSETS_DIR = Path(__file__).resolve().parents[2] / "assets" / "icons"
+INCOMPRESSIBLE_EXTENSIONS = frozenset(
+    {
+        ".jpg", ".jpeg", ".png", ".gif", ".webp", ".avif", ".heic",
+        ".mp4", ".webm", ".mov", ".mkv", ".avi",
+        ".mp3", ".ogg", ".flac", ".m4a", ".opus",
+        ".zip", ".7z", ".rar", ".gz", ".tgz", ".xz", ".bz2", ".zst",
+        ".pdf", ".docx", ".xlsx", ".pptx", ".odt", ".epub", ".jar", ".whl",
+    }
+)
+SMALL_SIZES = tuple(f"{size:3d} " for size in range(1024))
+SIZE_UNITS = (
+    (1 << 20, 1 << 10, "K"),
+    (1 << 30, 1 << 20, "M"),
+    (float("inf"), 1 << 30, "G"),
+)
+COPY_BUFFER_SIZE = 1 << 20
+MINUTE_CACHE_SIZE = 1 << 14
+SORT_PARAMS = ("C", "O", "apache")
 
 ICON_MAP = {
     "directory": "folder.gif",
@@ -49,6 +84,65 @@ ICON_MAP = {
     "default": "unknown.gif",
 }
 
+MIME_LABELS = {
+    "application/pdf": "   ",
+    "text/plain": "TXT",
+}
+
+# Every prefix is six characters long, so a lookup is one slice and one get.
+MIME_PREFIX_LABELS = {
+    "image/": "IMG",
+    "video/": "VID",
+    "audio/": "AUD",
+}
+
+DIRECTORY_CLASS = (ICON_MAP["directory"], "DIR")
+
+
+NOT_FOUND_PAGE = """<!DOCTYPE HTML PUBLIC "-//IETF//DTD HTML 2.0//EN">
+<html><head><title>404 Not Found</title></head><body>
+<h1>Not Found</h1>
+<p>The requested URL was not found on this server.</p>
+<hr><address>"""
+
+FORBIDDEN_PAGE = """<!DOCTYPE HTML PUBLIC "-//IETF//DTD HTML 2.0//EN">
+<html><head><title>403 Forbidden</title></head><body>
+<h1>Forbidden</h1>
+<p>You don't have permission to access this resource.</p>
+<hr><address>"""
+
+ERROR_PAGE_END = """</address>
+</body></html>"""
+
+
+class FileInfo(NamedTuple):
+    name: str
+    href: str
+    icon: str
+    type: str
+    modified: str
+    modified_timestamp: float
+    size_formatted: str
+    size_bytes: int
+    description: str
+    is_directory: bool
+
+
+SORT_KEYS = {
+    "name": attrgetter("name"),
+    "modified": attrgetter("modified_timestamp"),
+    "size": attrgetter("size_bytes"),
+    "description": attrgetter("description"),
+}
+
+LISTING_CACHE_SIZE = 256
+listing_cache = collections.OrderedDict()
+listing_cache_lock = threading.Lock()
+# Bumped whenever cached listings are dropped so page ETags change with them.
+# Seeded per process so an ETag issued by an earlier or sibling process never
+# matches one from this process.
+listing_generation = time.time_ns()
+
 
 def config():
     return app.config
@@ -62,107 +156,211 @@ def server_name():
         return "Flask Server"
 
 
-def inside_root(candidate: Path) -> bool:
-    root = config()["SERVE_ROOT"]
-    try:
-        return candidate.resolve().is_relative_to(root)
-    except AttributeError:
-        return os.path.commonpath(
-            [str(candidate.resolve()), str(root.resolve())]
-        ) == str(root.resolve())
+@functools.lru_cache(maxsize=8)
+def format_server_info(host: str, port: str) -> str:
+    return f"{config()['SERVER_BANNER']} at {host} Port {port}"
+
+
+def server_info() -> str:
+    host, _, port = request.host.partition(":")
+    return format_server_info(host, port or str(config()["PORT"]))
+
+
+def inside_root(path: str) -> bool:
+    """Check a normalised absolute path against the served root prefix."""
+    prefix = config()["SERVE_ROOT_PREFIX"]
+    return path.startswith(prefix) or path == prefix[:-1]
+
+
+def resolve_path(path: str):
+    """Normalise a path under the served root, or return None if it escapes.
+
+    The root itself is resolved at startup, so only the components below it
+    can be symlinks. They are checked one by one and the full realpath() is
+    only taken when one of them actually is a link.
+    """
+    path = os.path.normpath(path)
+    if not inside_root(path):
+        return None
+    prefix = config()["SERVE_ROOT_PREFIX"]
+    relative = path[len(prefix):]
+    current = prefix
+    for part in relative.split(os.sep) if relative else ():
+        current = os.path.join(current, part)
+        if os.path.islink(current):
+            path = os.path.realpath(path)
+            return path if inside_root(path) else None
+    return path
 
 
 def format_size(size: int) -> str:
-    if size == 0:
-        return "  0 "
-    step = 1024.0
-    if size < step:
-        return f"{size:3d} "
-    size_k = size / step
-    if size_k < step:
-        return f"{size_k:.1f}K" if size_k < 10 else f"{size_k:3.0f}K"
-    size_m = size_k / step
-    if size_m < step:
-        return f"{size_m:.1f}M" if size_m < 10 else f"{size_m:3.0f}M"
-    size_g = size_m / step
-    return f"{size_g:.1f}G" if size_g < 10 else f"{size_g:3.0f}G"
-
-
-def file_icon(path: Path, is_dir: bool) -> str:
-    if is_dir:
-        return ICON_MAP["directory"]
-    mime, _ = mimetypes.guess_type(path.name)
+    if size < 1024:
+        return SMALL_SIZES[size]
+    for limit, unit, suffix in SIZE_UNITS:
+        if size < limit:
+            break
+    value = size / unit
+    return "%.1f%s" % (value, suffix) if value < 10 else "%3.0f%s" % (value, suffix)
+
+
+@functools.lru_cache(maxsize=MINUTE_CACHE_SIZE)
+def format_minute(minute: int) -> str:
+    # The listing only shows minutes, and files in a directory tend to share
+    # them, so the formatted string is cached per minute since the epoch.
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(minute * 60))
+
+
+def file_ext(name: str) -> str:
+    stem, ext = os.path.splitext(name)
+    if ext.lower() in mimetypes.encodings_map:
+        ext = os.path.splitext(stem)[1] + ext
+    return ext.lower()
+
+
+def file_icon(mime) -> str:
     return ICON_MAP.get(mime or "default", ICON_MAP["default"])
 
 
-def file_label(path: Path, is_dir: bool) -> str:
-    if is_dir:
-        return "DIR"
-    if path.suffix.lower() == ".7z":
+def file_label(ext: str, mime) -> str:
+    if ext == ".7z" or not mime:
         return "   "
-    mime, _ = mimetypes.guess_type(path.name)
-    if mime:
-        if mime.startswith("image/"):
-            return "IMG"
-        if mime.startswith("video/"):
-            return "VID"
-        if mime.startswith("audio/"):
-            return "AUD"
-        if mime == "application/pdf":
-            return "   "
-        if mime == "text/plain":
-            return "TXT"
-        if "compressed" in mime or "zip" in mime:
-            return "ARC"
-    return "   "
+    label = MIME_LABELS.get(mime)
+    if label is None:
+        label = MIME_PREFIX_LABELS.get(mime[:6])
+    if label is None:
+        label = "ARC" if "compressed" in mime or "zip" in mime else "   "
+    return label
+
+
+@functools.lru_cache(maxsize=1024)
+def classify(ext: str) -> tuple:
+    """Return the (icon, type label) pair for a file extension."""
+    mime = mimetypes.guess_type("x" + ext)[0] if ext else None
+    return file_icon(mime), file_label(ext, mime)
+
+
+@functools.lru_cache(maxsize=None)
+def stat_pool(workers: int) -> ThreadPoolExecutor:
+    # stat() releases the GIL, so a few threads hide per-entry round trips
+    # on network filesystems such as NFS or SMB.
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stat")
+
+
+def cached_listing(key: tuple, version: int):
+    with listing_cache_lock:
+        cached = listing_cache.get(key)
+        if cached is None or cached[0] != version:
+            return None
+        listing_cache.move_to_end(key)
+        return cached[1]
+
+
+def store_listing(key: tuple, version: int, generation: int, entries: list):
+    with listing_cache_lock:
+        # An upload may have replaced a file while this listing was being
+        # scanned; the rows could be stale, so don't cache them.
+        if generation != listing_generation:
+            return
+        listing_cache[key] = (version, entries)
+        listing_cache.move_to_end(key)
+        if len(listing_cache) > LISTING_CACHE_SIZE:
+            listing_cache.popitem(last=False)
+
+
+def forget_listing(directory: str):
+    global listing_generation
+    with listing_cache_lock:
+        listing_generation += 1
+        for key in [key for key in listing_cache if key[0] == directory]:
+            del listing_cache[key]
 
 
 def directory_listing_data(
-    directory: Path, sort_by: str, sort_order: str, apache_style: bool
+    directory: str,
+    version: int,
+    generation: int,
+    sort_by: str,
+    sort_order: str,
+    apache_style: bool,
 ):
+    # `version` is the directory's st_mtime_ns, taken by the caller. It
+    # changes whenever an entry is added, removed or renamed, so it is a
+    # cheap validator for the cached listing. `generation` is the
+    # listing_generation read before the lookup.
+    key = (directory, sort_by, sort_order, apache_style)
+    cached = cached_listing(key, version)
+    if cached is not None:
+        return cached
+
     entries = []
     try:
-        for item in directory.iterdir():
-            if item.name.startswith("."):
-                continue
-            is_dir = item.is_dir()
-            stat = item.stat()
+        with os.scandir(directory) as it:
+            visible = [entry for entry in it if entry.name[:1] != "."]
+        if os.name != "nt":
+            # inode() comes straight from readdir on POSIX; stat'ing in inode
+            # order walks the inode table sequentially on a cold cache.
+            visible.sort(key=os.DirEntry.inode)
+        workers = config()["PARALLEL_STAT_WORKERS"]
+        if workers > 1 and len(visible) > 1:
+            stats = list(stat_pool(workers).map(os.DirEntry.stat, visible))
+        else:
+            stats = [entry.stat() for entry in visible]
+        # A listing with more entries than the cache holds can evict every
+        # minute before it is reused, so it bypasses the cache.
+        if len(visible) <= MINUTE_CACHE_SIZE:
+            format_mtime = format_minute
+        else:
+            format_mtime = format_minute.__wrapped__
+        for entry, stat in zip(visible, stats):
+            name = entry.name
+            is_dir = entry.is_dir()
+            mtime = stat.st_mtime
+            size = 0 if is_dir else stat.st_size
+            icon, label = DIRECTORY_CLASS if is_dir else classify(file_ext(name))
             entries.append(
-                {
-                    "name": item.name,
-                    "href": quote(item.name) + ("/" if is_dir else ""),
-                    "icon": file_icon(item, is_dir),
-                    "type": file_label(item, is_dir),
-                    "modified": datetime.fromtimestamp(stat.st_mtime).strftime(
-                        "%Y-%m-%d %H:%M"
-                    ),
-                    "modified_timestamp": stat.st_mtime,
-                    "size_formatted": format_size(stat.st_size)
-                    if not is_dir
-                    else "  - ",
-                    "size_bytes": stat.st_size if not is_dir else 0,
-                    "description": "",
-                    "is_directory": is_dir,
-                }
+                FileInfo(
+                    name,
+                    quote(name) + ("/" if is_dir else ""),
+                    icon,
+                    label,
+                    format_mtime(int(mtime // 60)),
+                    mtime,
+                    "  - " if is_dir else format_size(size),
+                    size,
+                    "",
+                    is_dir,
+                )
             )
     except (OSError, PermissionError):
         return []
 
-    def sort_key(entry):
-        value = {
-            "name": entry["name"],
-            "modified": entry["modified_timestamp"],
-            "size": entry["size_bytes"],
-            "description": entry["description"],
-        }[sort_by]
-        return value if apache_style else (not entry["is_directory"], value)
-
-    entries.sort(key=sort_key)
-    if sort_order == "D":
-        entries.reverse()
+    descending = sort_order == "D"
+    entries.sort(key=SORT_KEYS[sort_by], reverse=descending)
+    if not apache_style:
+        # list.sort is stable, so this keeps the column order within each group
+        entries.sort(key=attrgetter("is_directory"), reverse=not descending)
+    store_listing(key, version, generation, entries)
     return entries
 
 
+@functools.lru_cache(maxsize=None)
+def index_template():
+    # Rendering the compiled template directly skips render_template's
+    # context processors and signals; the template only needs `request`.
+    return app.jinja_env.get_template("index.html")
+
+
+def sort_params(query: str) -> dict:
+    # Apache separates parameters with ';' as well as '&'. Only a few short
+    # ASCII flags are read, so no percent-decoding is needed.
+    params = {}
+    for token in query.replace(";", "&").split("&"):
+        key, _, value = token.partition("=")
+        if value and key in SORT_PARAMS:
+            params[key] = value
+    return params
+
+
 def sort_url(column, current_column, current_order):
     apache_style = config()["APACHE_STYLE_SORTING"]
     if column == current_column:
@@ -177,20 +375,21 @@ def sort_url(column, current_column, current_order):
 def list_endpoint(subpath=""):
     subpath = unquote(subpath)
     root = config()["SERVE_ROOT"]
-    target = (root / subpath).resolve()
-    if not inside_root(target):
+    target = resolve_path(os.path.join(root, subpath))
+    if target is None:
         abort(403)
-    if not target.exists():
+    try:
+        target_stat = os.stat(target)
+    except OSError:
         abort(404)
-    if target.is_file():
+    if S_ISREG(target_stat.st_mode):
         return send_file(target)
 
     download_name = request.args.get("download")
     if download_name:
         return download_directory_as_zip(target, download_name)
 
-    raw_query = request.query_string.decode("utf-8").replace(";", "&")
-    params = {k: v[0] for k, v in parse_qs(raw_query).items() if v}
+    params = sort_params(request.query_string.decode("utf-8", "replace"))
     sort_column = params.get("C", "N")
     sort_order = params.get("O", "A")
     apache_style = config()["APACHE_STYLE_SORTING"]
@@ -203,7 +402,16 @@ def list_endpoint(subpath=""):
     sort_map = {"N": "name", "M": "modified", "S": "size", "D": "description"}
     sort_by = sort_map.get(sort_column, "name")
 
-    files = directory_listing_data(target, sort_by, sort_order, apache_style)
+    generation = listing_generation
+    files = directory_listing_data(
+        target, target_stat.st_mtime_ns, generation, sort_by, sort_order, apache_style
+    )
+    etag = f"{target_stat.st_mtime_ns}-{len(files)}-{generation}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
     parent_dir = None
     if subpath:
         parent = "/" + subpath.rstrip("/")
@@ -211,11 +419,10 @@ def list_endpoint(subpath=""):
         if parent_dir == "//":
             parent_dir = "/"
 
-    port = request.host.split(":")[1] if ":" in request.host else str(config()["PORT"])
-    info = f"{config()['SERVER_BANNER']} at {request.host.split(':')[0]} Port {port}"
+    info = server_info()
 
-    return render_template(
-        "index.html",
+    html = index_template().render(
+        request=request,
         path="/" + subpath.rstrip("/") if subpath else "/",
         icon_path=ICON_PATH,
         parent_dir=parent_dir,
@@ -224,8 +431,24 @@ def list_endpoint(subpath=""):
         sort_column=sort_column,
         server_info=info,
         files=files,
-        get_sort_url=lambda path, col, cur, order: sort_url(col, cur, order),
+        sort_urls={
+            column: sort_url(column, sort_column, sort_order) for column in "NMSD"
+        },
     )
+    response = Response(html, mimetype="text/html")
+    response.set_etag(etag)
+    return response
+
+
+def preallocate(out, size):
+    # The request body is a little larger than the file it carries; the
+    # caller truncates to the written size afterwards.
+    if not size or size < COPY_BUFFER_SIZE or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(out.fileno(), 0, size)
+    except OSError:
+        pass
 
 
 @app.route("/", methods=["POST"])
@@ -233,10 +456,10 @@ def list_endpoint(subpath=""):
 def upload_endpoint(subpath=""):
     subpath = unquote(subpath)
     root = config()["SERVE_ROOT"]
-    target_dir = (root / subpath).resolve()
-    if not inside_root(target_dir):
+    target_dir = resolve_path(os.path.join(root, subpath))
+    if target_dir is None:
         return jsonify({"success": False, "error": "Access denied"}), 403
-    if not target_dir.exists() or not target_dir.is_dir():
+    if not os.path.isdir(target_dir):
         return jsonify({"success": False, "error": "Directory not found"}), 404
     if "upload" not in request.args:
         return jsonify({"success": False, "error": "Invalid request"}), 400
@@ -250,15 +473,25 @@ def upload_endpoint(subpath=""):
     relative_path = (
         request.form.get("path", upload.filename).replace("\\", "/").lstrip("/")
     )
-    destination = (target_dir / relative_path).resolve()
-    if not inside_root(destination):
+    destination = resolve_path(os.path.join(target_dir, relative_path))
+    if destination is None:
         return jsonify({"success": False, "error": "Invalid path"}), 400
-    destination.parent.mkdir(parents=True, exist_ok=True)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
 
     try:
-        upload.save(destination)
+        with open(destination, "wb") as out:
+            preallocate(out, request.content_length)
+            try:
+                upload.save(out, COPY_BUFFER_SIZE)
+            finally:
+                # Drop the preallocated tail, even after a failed copy.
+                out.truncate(out.tell())
     except Exception as exc:
         return jsonify({"success": False, "error": str(exc)}), 500
+    finally:
+        # Overwriting an existing file leaves the directory mtime unchanged,
+        # and a failed overwrite has still replaced its contents.
+        forget_listing(os.path.dirname(destination))
 
     return jsonify(
         {"success": True, "message": f"File {relative_path} uploaded successfully"}
@@ -267,72 +500,166 @@ def upload_endpoint(subpath=""):
 
 @app.route("/icons/<path:filename>")
 def serve_assets(filename):
-    assets_dir = Path(__file__).resolve().parents[2] / "assets" / "icons"
-    file_path = (assets_dir / filename).resolve()
-    if not str(file_path).startswith(str(assets_dir)):
-        abort(403)
-    if not file_path.exists() or not file_path.is_file():
-        abort(404)
-    return send_file(file_path)
+    response = send_from_directory(ASSETS_DIR, filename, max_age=31536000)
+    response.cache_control.immutable = True
+    return response
 
 
 @app.errorhandler(404)
 def not_found(_):
-    port = request.host.split(":")[1] if ":" in request.host else str(config()["PORT"])
-    host = request.host.split(":")[0]
-    return (
-        f"""<!DOCTYPE HTML PUBLIC "-//IETF//DTD HTML 2.0//EN">
-<html><head><title>404 Not Found</title></head><body>
-<h1>Not Found</h1>
-<p>The requested URL was not found on this server.</p>
-<hr><address>{config()["SERVER_BANNER"]} at {host} Port {port}</address>
-</body></html>""",
-        404,
-    )
+    return NOT_FOUND_PAGE + server_info() + ERROR_PAGE_END, 404
 
 
 @app.errorhandler(403)
 def forbidden(_):
-    port = request.host.split(":")[1] if ":" in request.host else str(config()["PORT"])
-    host = request.host.split(":")[0]
-    return (
-        f"""<!DOCTYPE HTML PUBLIC "-//IETF//DTD HTML 2.0//EN">
-<html><head><title>403 Forbidden</title></head><body>
-<h1>Forbidden</h1>
-<p>You don't have permission to access this resource.</p>
-<hr><address>{config()["SERVER_BANNER"]} at {host} Port {port}</address>
-</body></html>""",
-        403,
-    )
+    return FORBIDDEN_PAGE + server_info() + ERROR_PAGE_END, 403
+
+
+class ZipStream:
+    """Write-only sink that hands ZipFile output to a streaming response."""
+
+    def __init__(self):
+        self.chunks = collections.deque()
+        self.offset = 0
 
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
 
-def download_directory_as_zip(directory: Path, child: str):
-    target = (directory / child).resolve()
-    if not inside_root(target) or not target.is_dir():
-        abort(403 if target.exists() else 404)
+    def tell(self):
+        return self.offset
 
-    temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix=".zip")
-    temp_zip.close()
+    def flush(self):
+        pass
+
+    def drain(self):
+        while self.chunks:
+            yield self.chunks.popleft()
+
+
+def scan_files(directory: str, prefix: str = ""):
     try:
-        with zipfile.ZipFile(temp_zip.name, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for root_dir, _, files in os.walk(target):
-                for name in files:
-                    if name.startswith("."):
-                        continue
-                    file_path = Path(root_dir) / name
-                    arc = file_path.relative_to(target)
-                    zipf.write(file_path, arc)
-        response = send_file(
-            temp_zip.name,
-            as_attachment=True,
-            download_name=f"{child}.zip",
-            mimetype="application/zip",
-        )
-        response.call_on_close(lambda: os.unlink(temp_zip.name))
-        return response
-    except Exception:
-        os.unlink(temp_zip.name)
-        abort(500)
+        with os.scandir(directory) as it:
+            entries = list(it)
+    except OSError:
+        return
+    for entry in entries:
+        if entry.name.startswith("."):
+            continue
+        arcname = prefix + entry.name
+        if entry.is_dir():
+            if not entry.is_symlink():
+                yield from scan_files(entry.path, arcname + "/")
+        elif entry.is_symlink():
+            path = resolve_path(entry.path)
+            if path is not None:
+                yield arcname, path, None, path
+        else:
+            yield arcname, entry.path, None, entry.path
+
+
+def walk_files(directory: str):
+    """Yield (arcname, path, dir_fd, full_path) for the visible files below
+    directory; full_path is used to vet symlinked files before opening them.
+    """
+    if not hasattr(os, "fwalk"):
+        yield from scan_files(directory)
+        return
+    # fwalk keeps each directory open, so files are opened relative to it
+    # instead of resolving the full path again for every member.
+    for root_dir, dirs, files, root_fd in os.fwalk(directory):
+        dirs[:] = [name for name in dirs if not name.startswith(".")]
+        relative = os.path.relpath(root_dir, directory)
+        prefix = "" if relative == "." else relative.replace(os.sep, "/") + "/"
+        for name in files:
+            if not name.startswith("."):
+                yield prefix + name, name, root_fd, os.path.join(root_dir, name)
+
+
+def open_regular_file(path: str, dir_fd, full_path: str):
+    # O_NONBLOCK keeps a FIFO from blocking the open; it is skipped below.
+    # O_NOFOLLOW makes symlinks fail so their target can be checked against
+    # the served root like any other request path.
+    flags = os.O_RDONLY | getattr(os, "O_NONBLOCK", 0) | getattr(os, "O_BINARY", 0)
+    flags |= getattr(os, "O_NOFOLLOW", 0)
+    try:
+        fd = os.open(path, flags, dir_fd=dir_fd)
+    except OSError as exc:
+        if exc.errno not in (errno.ELOOP, errno.EMLINK):
+            return None, None
+        resolved = resolve_path(full_path)
+        if resolved is None:
+            return None, None
+        try:
+            fd = os.open(resolved, flags)
+        except OSError:
+            return None, None
+    stat = os.fstat(fd)
+    if not S_ISREG(stat.st_mode):
+        os.close(fd)
+        return None, None
+    return open(fd, "rb", buffering=0), stat
+
+
+def zip_member(arcname: str, stat: os.stat_result) -> zipfile.ZipInfo:
+    date_time = time.localtime(stat.st_mtime)[:6]
+    # ZIP stores years 1980-2107 only; clamp like ZipInfo.from_file does
+    # with strict_timestamps=False.
+    if date_time[0] < 1980:
+        date_time = (1980, 1, 1, 0, 0, 0)
+    elif date_time[0] > 2107:
+        date_time = (2107, 12, 31, 23, 59, 59)
+    zinfo = zipfile.ZipInfo(arcname, date_time)
+    zinfo.external_attr = (stat.st_mode & 0xFFFF) << 16
+    zinfo.file_size = stat.st_size
+    if os.path.splitext(arcname)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        zinfo.compress_type = zipfile.ZIP_STORED
+    else:
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        # Same attribute ZipFile.write() sets for its compresslevel argument
+        zinfo._compresslevel = 1
+    return zinfo
+
+
+def zip_directory(target: str):
+    sink = ZipStream()
+    with zipfile.ZipFile(sink, "w", allowZip64=True) as zipf:
+        for arcname, path, dir_fd, full_path in walk_files(target):
+            src, stat = open_regular_file(path, dir_fd, full_path)
+            if src is None:
+                continue
+            with src, zipf.open(zip_member(arcname, stat), "w") as dst:
+                while True:
+                    chunk = src.read(COPY_BUFFER_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()
+
+
+def attachment_names(filename: str) -> dict:
+    try:
+        filename.encode("ascii")
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", filename)
+        simple = simple.encode("ascii", "ignore").decode("ascii")
+        return {"filename": simple, "filename*": f"UTF-8''{quote(filename)}"}
+    return {"filename": filename}
+
+
+def download_directory_as_zip(directory: str, child: str):
+    target = resolve_path(os.path.join(directory, child))
+    if target is None or not os.path.isdir(target):
+        abort(403 if target is None or os.path.exists(target) else 404)
+
+    response = Response(zip_directory(target), mimetype="application/zip")
+    response.headers.set(
+        "Content-Disposition", "attachment", **attachment_names(f"{child}.zip")
+    )
+    return response
 
 
 def parse_args():
@@ -346,6 +673,17 @@ def parse_args():
         action="store_true",
         help="Use Apache-style mixed sorting (directories not forced first)",
     )
+    parser.add_argument(
+        "--parallel-stat-workers",
+        type=int,
+        default=0,
+        help="Stat directory entries on this many threads (for network filesystems)",
+    )
+    parser.add_argument(
+        "--x-sendfile",
+        action="store_true",
+        help="Let a fronting server send files via the X-Sendfile header",
+    )
     return parser.parse_args()
 
 
@@ -354,9 +692,12 @@ def configure_from_args(options):
     root.mkdir(parents=True, exist_ok=True)
     app.config.update(
         SERVE_ROOT=root,
+        SERVE_ROOT_PREFIX=os.path.join(str(root), ""),
         APACHE_STYLE_SORTING=options.apache_style,
         SERVER_BANNER=server_name(),
         PORT=options.port,
+        PARALLEL_STAT_WORKERS=options.parallel_stat_workers,
+        USE_X_SENDFILE=options.x_sendfile,
     )
     return options
 